@@ -52,3 +52,6 @@ class MiniGPTConfig:
     to_clip_grad: bool = False
     gradient_clip: float = 1.0
     scheduler: bool = False
+    gradient_checkpointing: bool = (
+        False  # Recompute transformer layer activations in backward to save memory
+    )
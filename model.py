@@ -4,7 +4,7 @@ import math
 
 import torch
 import torch.nn as nn
-from einops import einsum, reduce, rearrange
+from torch.utils.checkpoint import checkpoint
 
 
 class BigramLanguageModel(nn.Module):
@@ -51,8 +51,6 @@ class BigramLanguageModel(nn.Module):
         # ========= TODO : START ========= #
 
         # raise NotImplementedError
-        if x.dim()<2:
-            x = x.unsqueeze(0)
         x = self.embeddings(x)
         x = self.linear(x)
         x = self.dropout(x)
@@ -94,19 +92,79 @@ class BigramLanguageModel(nn.Module):
 
         ### ========= TODO : START ========= ###
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        input_stream = context.to(device)
-        for i in range(max_new_tokens):
-            context = input_stream[-1:].to(device)
+        # Preallocate the output once on device and fill it in place, instead of
+        # growing it with torch.cat every step.
+        start = context.size(-1)
+        input_stream = torch.empty(start + max_new_tokens, dtype=torch.long, device=device)
+        input_stream[:start] = context
+        for i in range(start, start + max_new_tokens):
+            context = input_stream[i-1:i].unsqueeze(0)
             output = self.forward(context)
             prob = nn.functional.softmax(output, dim=-1)
             last_token_prob = prob[:, -1, :]
             pred = torch.multinomial(last_token_prob, num_samples=1)
-            pred = pred.view(-1)
-            input_stream = torch.cat((input_stream, pred), dim=-1).to(device)
+            input_stream[i:i+1] = pred.view(-1)
         return input_stream
         ### ========= TODO : END ========= ###
 
 
+def causal_attention(Q, K, V, causal_mask, dropout):
+    """
+    Scaled dot product attention with a causal mask.
+
+    Args:
+    Q, K, V : torch.Tensor
+        Tensors of shape (..., num_tokens, dim) containing the queries, keys and values.
+        Q may hold fewer tokens than K and V, in which case the queries are taken to be
+        the last Q.size(-2) positions (as when decoding with a KV cache).
+    causal_mask : torch.Tensor
+        The (max_len, max_len) upper triangular boolean mask of a SingleHeadAttention layer.
+        Only used when scaled_dot_product_attention is not available or the queries are
+        offset from the keys.
+    dropout : nn.Dropout
+        Dropout applied to the attention weights.
+
+    Output:
+    torch.Tensor
+        A tensor of shape (..., num_tokens, value_dim) containing the attended values.
+    """
+
+    *batch_dims, T_q, d_k = Q.shape
+    T_k = K.size(-2)
+    offset = T_k - T_q
+
+    if hasattr(nn.functional, "scaled_dot_product_attention"):
+        if offset == 0:
+            # No explicit attn_mask here, a mask tensor would keep SDPA off the flash kernels.
+            return nn.functional.scaled_dot_product_attention(
+                Q, K, V,
+                dropout_p=dropout.p if dropout.training else 0.0,
+                is_causal=True,
+            )
+        # is_causal aligns the mask to the top-left, so offset queries need it explicitly.
+        # A single query sees every key and needs no mask at all.
+        attn_mask = None if T_q == 1 else ~causal_mask[offset:T_k,0:T_k]
+        return nn.functional.scaled_dot_product_attention(
+            Q, K, V,
+            attn_mask=attn_mask,
+            dropout_p=dropout.p if dropout.training else 0.0,
+        )
+
+    # Flatten the batch (and head) dims so the scores are a true bmm, and fold the
+    # 1/sqrt(d_k) scale into it through alpha instead of a separate division.
+    Q = Q.reshape(-1, T_q, d_k)
+    K = K.reshape(-1, T_k, d_k)
+    V = V.reshape(-1, T_k, V.size(-1))
+    out = torch.baddbmm(
+        torch.empty(Q.size(0), T_q, T_k, device=Q.device, dtype=Q.dtype),
+        Q, K.transpose(-2, -1),
+        beta=0.0, alpha=1.0/math.sqrt(d_k),
+    )
+    out.masked_fill_(causal_mask[offset:T_k,0:T_k], float("-inf"))
+    out = dropout(nn.functional.softmax(out,dim=-1))
+    return torch.bmm(out, V).view(*batch_dims, T_q, V.size(-1))
+
+
 class SingleHeadAttention(nn.Module):
     """
     Class definition for Single Head Causal Self Attention Layer.
@@ -158,7 +216,7 @@ class SingleHeadAttention(nn.Module):
         self.value = nn.Linear(self.input_dim, self.output_value_dim, bias=False)
         self.dropout = nn.Dropout(dropout)
 
-        causal_mask = torch.triu(torch.ones((max_len,max_len)),diagonal=1)
+        causal_mask = torch.triu(torch.ones((max_len,max_len), dtype=torch.bool),diagonal=1)
         # ========= TODO : END ========= #
 
         self.register_buffer(
@@ -184,11 +242,7 @@ class SingleHeadAttention(nn.Module):
         K = self.key(x)
         V = self.value(x)
 
-        out = torch.matmul(Q, K.transpose(-2, -1))/math.sqrt(self.output_key_query_dim)
-        M = self.causal_mask[0:out.size(-2),0:out.size(-1)]
-        out.masked_fill_(M == 1, -1e10)
-        out = self.dropout(nn.functional.softmax(out,dim=-1))
-        return torch.matmul(out, V)
+        return causal_attention(Q, K, V, self.causal_mask, self.dropout)
 
         # ========= TODO : END ========= #
 
@@ -219,22 +273,29 @@ class MultiHeadAttention(nn.Module):
         # ========= TODO : START ========= #
 
         head_dim = int(self.input_dim/num_heads)
+        self.head_dim = head_dim
         for i in range(self.num_heads):
             setattr(self, f"head_{i}", SingleHeadAttention(input_dim=self.input_dim,
                                                            output_key_query_dim=head_dim,
                                                            output_value_dim=head_dim))
+        # The heads stay registered as head_{i} (the checkpoint keys), the plain tuple only
+        # lets forward iterate over them without getattr lookups.
+        self._heads = tuple(getattr(self, f"head_{i}") for i in range(self.num_heads))
         self.out = nn.Linear(self.input_dim,self.input_dim,bias=True)
         self.dropout = nn.Dropout(dropout)
 
         # ========= TODO : END ========= #
 
-    def forward(self, x):
+    def forward(self, x, kv_cache=None):
         """
         Forward pass of the Multi Head Attention Layer.
 
         Args:
         x : torch.Tensor
             A tensor of shape (batch_size, num_tokens, token_dim) containing the input tokens.
+        kv_cache : Optional[dict]
+            Keys and values of the previously seen tokens under "K" and "V". If given, x only
+            holds the new tokens; their keys and values are appended to the cache in place.
 
         Output:
         torch.Tensor
@@ -243,11 +304,25 @@ class MultiHeadAttention(nn.Module):
 
         # ========= TODO : START ========= #
 
-        values = []
-        for i in range(self.num_heads):
-            head = getattr(self, f"head_{i}")
-            values.append(head(x))
-        out = torch.cat(values, dim=-1)
+        # The per-head projections are stacked into one [W_Q; W_K; W_V] weight so that
+        # Q, K and V for every head come out of a single matmul over x.
+        B, T, _ = x.shape
+        qkv_weight = torch.cat(
+            [head.query.weight for head in self._heads]
+            + [head.key.weight for head in self._heads]
+            + [head.value.weight for head in self._heads],
+            dim=0,
+        )
+        qkv = nn.functional.linear(x, qkv_weight)
+        qkv = qkv.view(B, T, 3, self.num_heads, self.head_dim).permute(2, 0, 3, 1, 4)
+        Q, K, V = qkv[0], qkv[1], qkv[2]
+        if kv_cache is not None:
+            if "K" in kv_cache:
+                K = torch.cat([kv_cache["K"], K], dim=-2)
+                V = torch.cat([kv_cache["V"], V], dim=-2)
+            kv_cache["K"], kv_cache["V"] = K, V
+        out = causal_attention(Q, K, V, self.head_0.causal_mask, self.head_0.dropout)
+        out = out.transpose(1, 2).reshape(B, T, self.input_dim)
         out = self.out(out)
         out = self.dropout(out)
         return out
@@ -343,13 +418,12 @@ class LayerNorm(nn.Module):
 
         # ========= TODO : START ========= #
 
-        mean = torch.mean(input, dim=-1)
-        variance = torch.var(input, dim=-1, correction=0)
-        #.repeat(1,1,input.size(2))
-        mean = mean.unsqueeze(-1)
-        variance = variance.unsqueeze(-1)
-        out = (input-mean)/torch.sqrt(variance+self.eps)*self.gamma + self.beta
-        return out
+        # Single fused kernel instead of mean/var/sub/div/sqrt/mul/add passes.
+        if self.elementwise_affine:
+            return nn.functional.layer_norm(
+                input, self.normalized_shape, self.gamma, self.beta, self.eps
+            )
+        return nn.functional.layer_norm(input, self.normalized_shape, eps=self.eps)
 
         # ========= TODO : END ========= #
 
@@ -383,13 +457,15 @@ class TransformerLayer(nn.Module):
 
         # ========= TODO : END ========= #
 
-    def forward(self, x):
+    def forward(self, x, kv_cache=None):
         """
         Forward pass of the Transformer Layer.
 
         Args:
         x : torch.Tensor
             A tensor of shape (batch_size, num_tokens, token_dim) containing the input tokens.
+        kv_cache : Optional[dict]
+            Attention KV cache of this layer, see MultiHeadAttention.forward.
 
         Output:
         torch.Tensor
@@ -399,7 +475,7 @@ class TransformerLayer(nn.Module):
         # ========= TODO : START ========= #
 
         out = self.norm1(x)
-        out = self.attention(out)
+        out = self.attention(out, kv_cache=kv_cache)
         cache = out + x
         out = self.norm2(cache)
         out = self.feedforward(out)
@@ -437,6 +513,8 @@ class MiniGPT(nn.Module):
             config.context_length, config.embed_dim
         )
         self.embed_dropout = nn.Dropout(config.embed_dropout)
+        self.context_length = config.context_length
+        self.gradient_checkpointing = config.gradient_checkpointing
 
         self.transformer_layers = nn.ModuleList(
             [
@@ -457,13 +535,16 @@ class MiniGPT(nn.Module):
         if config.weight_tie:
             self.head.weight = self.vocab_embedding.weight
 
+        # shared stand-in for "no KV cache", one None per layer
+        self._no_cache = (None,) * config.num_layers
+
         # precreate positional indices for the positional embedding
         pos = torch.arange(0, config.context_length, dtype=torch.long)
         self.register_buffer("pos", pos, persistent=False)
 
         self.apply(self._init_weights)
 
-    def forward(self, x):
+    def forward(self, x, kv_cache=None, last_only=False):
         """
         Forward pass of the MiniGPT model.
 
@@ -472,22 +553,35 @@ class MiniGPT(nn.Module):
         Args:
         x : torch.Tensor
             A tensor of shape (batch_size, seq_len) containing the input tokens.
+        kv_cache : Optional[List[dict]]
+            One attention KV cache per transformer layer (start with empty dicts). If given,
+            x holds the tokens that follow the cached ones and the caches are extended in place.
+        last_only : bool
+            Only compute the logits of the last token, as needed for generation.
 
         Output:
         torch.Tensor
-            A tensor of shape (batch_size, seq_len, vocab_size) containing the logits.
+            A tensor of shape (batch_size, seq_len, vocab_size) containing the logits,
+            or (batch_size, 1, vocab_size) if last_only is set.
         """
 
         ### ========= TODO : START ========= ###
 
-        if x.dim()<2: # means x.shape = seq_len, unsqueeze to make it 1xseq_len
-            x = x.unsqueeze(0)
         out = self.vocab_embedding(x)
-        position = self.positional_embedding(self.pos)[:out.size(-2),:]
+        past = kv_cache[0]["K"].size(-2) if kv_cache and "K" in kv_cache[0] else 0
+        position = self.positional_embedding(self.pos[past:past+out.size(-2)])
         out = out + position
         out = self.embed_dropout(out)
-        for transformer in self.transformer_layers:
-            out = transformer(out)
+        if kv_cache is None:
+            kv_cache = self._no_cache
+        for transformer, layer_cache in zip(self.transformer_layers, kv_cache):
+            if self.gradient_checkpointing and self.training and torch.is_grad_enabled():
+                # Drop the layer's activations and recompute them in backward.
+                out = checkpoint(transformer, out, layer_cache, use_reentrant=False)
+            else:
+                out = transformer(out, kv_cache=layer_cache)
+        if last_only:
+            out = out[:, -1:, :]
         out = self.prehead_norm(out)
         out = self.head(out)
         return out
@@ -524,15 +618,22 @@ class MiniGPT(nn.Module):
         ### ========= TODO : START ========= ###
 
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        input_stream = context.to(device)
-        for i in range(max_new_tokens):
-            context = input_stream[-10:].to(device)
-            output = self.forward(context)
-            prob = nn.functional.softmax(output, dim=-1)
-            last_token_prob = prob[:, -1, :]
-            pred = torch.multinomial(last_token_prob, num_samples=1).to(device)
-            pred = pred.view(-1)
-            input_stream = torch.cat((input_stream, pred), dim=-1).to(device)
+        start = context.size(-1)
+        input_stream = torch.empty(start + max_new_tokens, dtype=torch.long, device=device)
+        input_stream[:start] = context
+        kv_cache = None
+        for i in range(start, start + max_new_tokens):
+            if kv_cache is None or i > self.context_length:
+                # Positions are absolute, so once the window slides the cached keys and
+                # values are stale and the cache is rebuilt from the last context_length tokens.
+                kv_cache = [{} for _ in self.transformer_layers]
+                context = input_stream[max(0, i-self.context_length):i].unsqueeze(0)
+            else:
+                context = input_stream[i-1:i].unsqueeze(0)
+            output = self.forward(context, kv_cache=kv_cache, last_only=True)
+            last_token_prob = nn.functional.softmax(output.squeeze(1), dim=-1)
+            pred = torch.multinomial(last_token_prob, num_samples=1)
+            input_stream[i:i+1] = pred.view(-1)
         return input_stream
 
         ### ========= TODO : END ========= ###
@@ -569,7 +670,7 @@ class Encoder(nn.Module):
         self.register_buffer("pos", pos, persistent=False)
     def forward(self, x):
         out = self.vocab_embedding(x)
-        position = self.positional_embedding(self.pos)[:out.size(-2),:]
+        position = self.positional_embedding(self.pos[:out.size(-2)])
         out = out + position
         out = self.embed_dropout(out)
         for encoder in self.encoder_blocks: